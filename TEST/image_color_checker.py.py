@@ -7,8 +7,7 @@ def is_grayscale_or_bw(image, threshold=0.05, color_threshold=0.1):
     if len(image.shape) == 2 or (len(image.shape) == 3 and image.shape[2] == 1):
         return True
 
-    rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    r, g, b = rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2]
+    b, g, r = image[:, :, 0], image[:, :, 1], image[:, :, 2]
 
     diff_rg = np.abs(r - g)
     diff_rb = np.abs(r - b)
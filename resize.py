@@ -1,8 +1,14 @@
+import io
 import logging
+import math
+import os
 import sys
 from enum import Enum
+from functools import partial
 from pathlib import Path
-from typing import List, Tuple
+from queue import Queue
+from threading import Event, Thread
+from typing import Callable, Dict, FrozenSet, List, Optional, Tuple
 
 from PIL import Image
 import typer
@@ -10,6 +16,25 @@ from rich import print
 from rich.logging import RichHandler
 from rich.progress import BarColumn, Progress, TimeRemainingColumn
 
+# Inputs are trusted local files, often upscaler output well above Pillow's
+# decompression bomb limit.
+Image.MAX_IMAGE_PIXELS = None
+
+SUPPORTED_EXTENSIONS: FrozenSet[str] = frozenset((
+    '.jpg', '.jpeg', '.png', '.webp', '.bmp', '.eps', '.gif',
+    '.ico', '.msp', '.pcx', '.ppm', '.spider', '.tif', '.tiff', '.xbm', '.xpm'
+))
+
+# Images whose decoded size exceeds this are resized in horizontal bands of
+# about BAND_BYTES of source pixels each to bound peak memory.
+BAND_RESIZE_THRESHOLD_BYTES = 500 << 20
+BAND_BYTES = 32 << 20
+
+# With --shrink-to-fit, an image whose lowest JPEG quality is still over
+# --max-size-mb is shrunk by a predicted factor and the quality search retried
+# at most this many times.
+MAX_DOWNSCALE_ATTEMPTS = 3
+
 
 class ResizeMode(str, Enum):
     LONGEST_EDGE = "LONGEST_EDGE"
@@ -26,11 +51,11 @@ class Resize:
     resize_mode: ResizeMode = None
     skip_existing: bool = None
     delete_input: bool = None
+    workers: int = None
+    shrink_to_fit: bool = None
     log: logging.Logger = None
-    supported_extensions: List[str] = [
-        '.jpg', '.jpeg', '.png', '.webp', '.bmp', '.eps', '.gif',
-        '.ico', '.msp', '.pcx', '.ppm', '.spider', '.tif', '.tiff', '.xbm', '.xpm'
-    ]
+    _target_size_cache: Dict[Tuple[int, int], Tuple[int, int]] = None
+    supported_extensions: FrozenSet[str] = SUPPORTED_EXTENSIONS
 
     def __init__(
         self,
@@ -41,6 +66,8 @@ class Resize:
         resize_mode: ResizeMode,
         skip_existing: bool = False,
         delete_input: bool = False,
+        workers: int = os.cpu_count() or 1,
+        shrink_to_fit: bool = False,
         log: logging.Logger = logging.getLogger(),
     ) -> None:
         self.input = input.resolve()
@@ -50,7 +77,10 @@ class Resize:
         self.resize_mode = resize_mode
         self.skip_existing = skip_existing
         self.delete_input = delete_input
+        self.workers = max(1, workers)
+        self.shrink_to_fit = shrink_to_fit
         self.log = log
+        self._target_size_cache = {}
 
     def run(self) -> None:
         if not self.input.exists():
@@ -65,8 +95,14 @@ class Resize:
         elif not self.output.exists():
             self.output.mkdir(parents=True)
 
-        images = list(self.input.rglob("*.*"))
-        images = [img for img in images if img.suffix.lower() in self.supported_extensions]
+        images = [img for img in self.input.rglob("*.*") if img.suffix.lower() in self.supported_extensions]
+
+        # Queueing, decoding/resizing/encoding and writing run as separate stages
+        # joined by bounded queues, so output I/O overlaps with the CPU-bound work
+        # in the worker threads (PIL releases the GIL while decoding, resampling
+        # and encoding) and at most a few images are held in memory at once.
+        read_queue: Queue = Queue(maxsize=self.workers * 2)
+        write_queue: Queue = Queue(maxsize=self.workers * 2)
 
         with Progress(
             "[progress.description]{task.description}",
@@ -75,45 +111,155 @@ class Resize:
             TimeRemainingColumn(),
         ) as progress:
             task_resizing = progress.add_task("Resizing", total=len(images))
+            advance = partial(progress.advance, task_resizing)
+
+            # Set on Ctrl-C (or any error in this thread): the first stage stops
+            # queueing files and the later stages drain what is left without
+            # resizing, writing or deleting anything, so every thread exits.
+            stop = Event()
+            threads = [Thread(target=self._queue_images, args=(images, read_queue, advance, stop))]
+            threads += [
+                Thread(target=self._process_images, args=(read_queue, write_queue, advance, stop))
+                for _ in range(self.workers)
+            ]
+            threads.append(Thread(target=self._write_images, args=(write_queue, advance, stop)))
+            for thread in threads:
+                thread.start()
+            try:
+                for thread in threads:
+                    thread.join()
+            except BaseException:
+                stop.set()
+                for thread in threads:
+                    thread.join()
+                raise
+
+    def _queue_images(
+        self, images: List[Path], read_queue: Queue, advance: Callable[[], None], stop: Event
+    ) -> None:
+        idx_width = len(str(len(images)))
+        try:
             for idx, img_path in enumerate(images, 1):
-                self.process_image(img_path, idx, len(images))
-                progress.advance(task_resizing)
+                if stop.is_set():
+                    break
+                img_input_path_rel = img_path
+                try:
+                    img_input_path_rel = img_path.relative_to(self.input)
+                    output_dir = self.output.joinpath(img_input_path_rel).parent
+                    img_output_path = output_dir.joinpath(img_path.name)
+                    output_dir.mkdir(parents=True, exist_ok=True)
 
-    def process_image(self, img_path: Path, idx: int, total: int) -> None:
-        img_input_path_rel = img_path.relative_to(self.input)
-        output_dir = self.output.joinpath(img_input_path_rel).parent
-        img_output_path = output_dir.joinpath(img_path.name)
-        output_dir.mkdir(parents=True, exist_ok=True)
+                    # Lazy %-formatting: the message is only built when INFO is enabled
+                    # (--verbose), which matters for batches of many small files.
+                    self.log.info('Processing %0*d: "%s"', idx_width, idx, img_input_path_rel)
 
-        self.log.info(f'Processing {str(idx).zfill(len(str(total)))}: "{img_input_path_rel}"')
+                    if self.skip_existing and img_output_path.is_file():
+                        self.log.warning("Already exists, skipping")
+                        if self.delete_input:
+                            img_path.unlink(missing_ok=True)
+                        advance()
+                        continue
 
-        if self.skip_existing and img_output_path.is_file():
-            self.log.warning("Already exists, skipping")
-            if self.delete_input:
-                img_path.unlink(missing_ok=True)
-            return
+                    read_queue.put((img_path, img_input_path_rel, img_output_path))
+                except Exception as e:
+                    self.log.error(f'An error occurred while preparing "{img_input_path_rel}": {str(e)}')
+                    advance()
+        finally:
+            # Always release the workers, even if the loop died.
+            for _ in range(self.workers):
+                read_queue.put(None)
 
+    def _process_images(
+        self, read_queue: Queue, write_queue: Queue, advance: Callable[[], None], stop: Event
+    ) -> None:
         try:
-            image = Image.open(img_path).convert("RGB")
-            resized_image = self._resize_to_max_dimensions(image)
-            self._reduce_file_size_and_save(resized_image, img_output_path)
+            while (item := read_queue.get()) is not None:
+                if stop.is_set():
+                    continue
+                img_path, img_input_path_rel, img_output_path = item
+                try:
+                    with Image.open(img_path) as image:
+                        target_size = self._calculate_target_size(*image.size)
+                        # JPEGs are decoded at 1/2, 1/4 or 1/8 scale straight from the DCT
+                        # coefficients when that still covers target_size; a no-op for
+                        # other formats.
+                        image.draft("RGB", target_size)
+                        if image.mode != "RGB":
+                            image = image.convert("RGB")
+                        resized_image = self._resize_to_max_dimensions(image, target_size)
+                        data = self._reduce_file_size(resized_image)
+                    write_queue.put((img_path, img_input_path_rel, img_output_path, data))
+                except Exception as e:
+                    self.log.error(f'An error occurred while processing "{img_input_path_rel}": {str(e)}')
+                    advance()
+        finally:
+            write_queue.put(None)
 
-            if self.delete_input:
-                img_path.unlink(missing_ok=True)
+    def _write_images(self, write_queue: Queue, advance: Callable[[], None], stop: Event) -> None:
+        remaining_workers = self.workers
+        while remaining_workers:
+            item = write_queue.get()
+            if item is None:
+                remaining_workers -= 1
+                continue
+            if stop.is_set():
+                continue
 
-            self.log.info(f"Image successfully resized and saved as {img_output_path}")
-        except Exception as e:
-            self.log.error(f"An error occurred while processing the image: {str(e)}")
+            img_path, img_input_path_rel, img_output_path, data = item
+            try:
+                img_output_path.write_bytes(data)
 
-    def _resize_to_max_dimensions(self, image: Image.Image) -> Image.Image:
-        width, height = image.size
-        target_size = self._calculate_target_size(width, height)
+                if self.delete_input:
+                    img_path.unlink(missing_ok=True)
+
+                self.log.info("Image successfully resized and saved as %s", img_output_path)
+            except Exception as e:
+                self.log.error(f'An error occurred while saving "{img_input_path_rel}": {str(e)}')
+            advance()
 
+    def _resize_to_max_dimensions(self, image: Image.Image, target_size: Tuple[int, int]) -> Image.Image:
+        width, height = image.size
         if width > target_size[0] or height > target_size[1]:
-            return image.resize(target_size, Image.LANCZOS)
+            if width * height * len(image.getbands()) > BAND_RESIZE_THRESHOLD_BYTES:
+                return self._resize_in_bands(image, target_size)
+            # With reducing_gap=2.0 Pillow first shrinks by int(ratio / 2) with a
+            # cheap box reduce, leaving Lanczos a final step of 2x to <4x. This
+            # kicks in from 4x downscales (e.g. 4K to 1K) upwards.
+            return image.resize(target_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
         return image
 
+    def _resize_in_bands(self, image: Image.Image, target_size: Tuple[int, int]) -> Image.Image:
+        # Resampling a huge image in one go allocates intermediate buffers as
+        # large as the source. Resizing horizontal bands keeps them around
+        # BAND_BYTES; Pillow reads the filter support around each box from the
+        # full image, so there are no seams between bands. reducing_gap is left
+        # out because its box pre-reduce would be aligned per band.
+        width, height = image.size
+        new_width, new_height = target_size
+        scale_y = height / new_height
+        band_rows = max(1, int(BAND_BYTES / (width * len(image.getbands()) * scale_y)))
+
+        resized_image = Image.new(image.mode, target_size)
+        for y0 in range(0, new_height, band_rows):
+            y1 = min(y0 + band_rows, new_height)
+            band = image.resize(
+                (new_width, y1 - y0),
+                Image.Resampling.LANCZOS,
+                box=(0, y0 * scale_y, width, y1 * scale_y),
+            )
+            resized_image.paste(band, (0, y0))
+        return resized_image
+
     def _calculate_target_size(self, width: int, height: int) -> Tuple[int, int]:
+        # Batches (e.g. upscaler output) usually share one source size, so the
+        # mode/aspect arithmetic is done once per distinct size.
+        target_size = self._target_size_cache.get((width, height))
+        if target_size is None:
+            target_size = self._compute_target_size(width, height)
+            self._target_size_cache[(width, height)] = target_size
+        return target_size
+
+    def _compute_target_size(self, width: int, height: int) -> Tuple[int, int]:
         aspect_ratio = width / height
         max_size = self.max_size_px
 
@@ -140,15 +286,70 @@ class Resize:
 
         return (new_width, new_height)
 
-    def _reduce_file_size_and_save(self, image: Image.Image, output_path: Path) -> None:
-        quality = 95
-        while True:
-            image.save(output_path, format="JPEG", quality=quality)
-            if output_path.stat().st_size <= self.max_size_mb * 1024 * 1024:
+    def _reduce_file_size(self, image: Image.Image) -> bytes:
+        max_size_bytes = self.max_size_mb * 1024 * 1024
+        previous_round = None
+        for _ in range(MAX_DOWNSCALE_ATTEMPTS + 1):
+            data, smallest_size = self._search_quality(image, max_size_bytes)
+            if data is not None:
+                return data
+            if not self.shrink_to_fit:
+                break
+
+            # Even the lowest quality is too big. Model the JPEG size as
+            # pixels ** exponent and predict the scale that fits (with a 5%
+            # margin). The exponent starts at 1 and is refitted from the last
+            # two rounds, since a downscaled image packs more detail into each
+            # pixel and shrinks less than its pixel count.
+            width, height = image.size
+            pixels = width * height
+            exponent = 1.0
+            if previous_round is not None:
+                previous_pixels, previous_size = previous_round
+                if previous_size > smallest_size:
+                    exponent = math.log(previous_size / smallest_size) / math.log(previous_pixels / pixels)
+                    exponent = min(max(exponent, 0.25), 1.0)
+            previous_round = (pixels, smallest_size)
+
+            scale = (max_size_bytes * 0.95 / smallest_size) ** (1 / (2 * exponent))
+            new_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+            if new_size == (width, height):
                 break
-            quality -= 5
-            if quality < 20:
-                raise ValueError("Cannot reduce file size to the desired size.")
+            self.log.warning(
+                "Lowest quality exceeds %s MB, reducing %dx%d to %dx%d",
+                self.max_size_mb, width, height, *new_size,
+            )
+            image = image.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+        raise ValueError("Cannot reduce file size to the desired size.")
+
+    def _search_quality(self, image: Image.Image, max_size_bytes: float) -> Tuple[Optional[bytes], Optional[int]]:
+        # File size grows with quality, so binary search the 95..20 range
+        # (step 5) for the highest quality that fits. The first probe is 95,
+        # which is enough for most images. Returns the best encode (or None)
+        # and the size of the smallest failing encode (None if 95 fitted).
+        qualities = range(20, 100, 5)
+        best = None
+        smallest_size = None
+        low, high = 0, len(qualities) - 1
+        mid = high
+        while low <= high:
+            data = self._encode_jpeg(image, qualities[mid])
+            if len(data) <= max_size_bytes:
+                best = data
+                low = mid + 1
+            else:
+                smallest_size = len(data)
+                high = mid - 1
+            mid = (low + high) // 2
+        return best, smallest_size
+
+    def _encode_jpeg(self, image: Image.Image, quality: int) -> bytes:
+        buffer = io.BytesIO()
+        # 4:2:0 chroma subsampling and a single Huffman pass keep trial encodes
+        # small and fast; the size search makes optimize's savings unnecessary.
+        image.save(buffer, format="JPEG", quality=quality, subsampling=2, optimize=False)
+        return buffer.getvalue()
 
 
 app = typer.Typer()
@@ -163,6 +364,11 @@ def main(
     resize_mode: ResizeMode = typer.Option(ResizeMode.LONGEST_EDGE, "--mode", "-m", help="Resize mode"),
     skip_existing: bool = typer.Option(False, "--skip-existing", "-se", help="Skip existing output files"),
     delete_input: bool = typer.Option(False, "--delete-input", "-di", help="Delete input files after resizing"),
+    workers: int = typer.Option(os.cpu_count() or 1, "--workers", "-w", help="Number of images processed in parallel"),
+    shrink_to_fit: bool = typer.Option(
+        False, "--shrink-to-fit", "-sf",
+        help="Go below --max-size-px when even the lowest JPEG quality exceeds --max-size-mb"
+    ),
     verbose: bool = typer.Option(False, "--verbose", "-v", help="Verbose mode"),
 ):
     logging.basicConfig(
@@ -180,6 +386,8 @@ def main(
         resize_mode=resize_mode,
         skip_existing=skip_existing,
         delete_input=delete_input,
+        workers=workers,
+        shrink_to_fit=shrink_to_fit,
     )
     resize.run()
 
@@ -117,18 +117,26 @@ class Upscale:
         if len(image.shape) == 2 or (len(image.shape) == 3 and image.shape[2] == 1):
             return True
 
-        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        r, g, b = rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2]
-
-        diff_rg = np.abs(r - g)
-        diff_rb = np.abs(r - b)
-        diff_gb = np.abs(g - b)
-
-        if (np.mean(diff_rg) < threshold) and (np.mean(diff_rb) < threshold) and (np.mean(diff_gb) < threshold):
+        # Both checks are means, so a thumbnail gives the same answer at a
+        # fraction of the cost.
+        if max(image.shape[:2]) > 512:
+            image = cv2.resize(image, (256, 256), interpolation=cv2.INTER_AREA)
+
+        # Diffing BGR against its rotation GRB yields |b-g|, |g-r| and |r-b| as
+        # three channels, so one absdiff and one mean cover all pairs in a single
+        # pass. cv2.absdiff also avoids the uint8 wrap-around of r - g.
+        bgr = image[:, :, :3]
+        diff_bg, diff_gr, diff_rb = cv2.mean(cv2.absdiff(bgr, bgr[:, :, [1, 2, 0]]))[:3]
+
+        if (diff_bg < threshold) and (diff_gr < threshold) and (diff_rb < threshold):
             return True
 
-        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-        if np.mean(hsv[:, :, 1]) < color_threshold * 255:
+        # Mean HSV saturation without the full HSV conversion: OpenCV defines
+        # S as (max - min) / max of the three channels (0 for black pixels).
+        max_channel = bgr.max(axis=2)
+        min_channel = bgr.min(axis=2)
+        saturation = (max_channel - min_channel) / np.maximum(max_channel, 1).astype(np.float32)
+        if saturation.mean() < color_threshold:
             return True
 
         return False
@@ -262,9 +270,11 @@ class Upscale:
                 if len(img.shape) < 3:
                     img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
 
-                is_grayscale = self.is_grayscale_or_bw(img)
-
-                current_model = self.grayscale_model if is_grayscale else self.model_str
+                # Only pay for the classification when there is a model to switch to.
+                if self.grayscale_model and self.is_grayscale_or_bw(img):
+                    current_model = self.grayscale_model
+                else:
+                    current_model = self.model_str
 
                 model_chain = (
                     current_model.split("+")
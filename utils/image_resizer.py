@@ -1,9 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import Enum
-from os import stat
+from io import BytesIO
+from math import log
+from os import cpu_count
 from pathlib import Path
 from PIL import Image
-from typing import List, Tuple
+from typing import FrozenSet, Optional, Tuple
+
+Image.MAX_IMAGE_PIXELS = None
+
+SUPPORTED_EXTENSIONS: FrozenSet[str] = frozenset((
+    '.jpg', '.jpeg', '.png', '.webp', '.bmp', '.eps', '.gif',
+    '.ico', '.msp', '.pcx', '.ppm', '.spider', '.tif', '.tiff', '.xbm', '.xpm'
+))
+
+MAX_DOWNSCALE_ATTEMPTS: int = 3
 
 
 class ResizeMode(Enum):
@@ -21,10 +33,8 @@ class ImageResizer:
     max_size_mb: float
     max_size_px: int
     resize_mode: ResizeMode
-    supported_extensions: List[str] = (
-        '.jpg', '.jpeg', '.png', '.webp', '.bmp', '.eps', '.gif',
-        '.ico', '.msp', '.pcx', '.ppm', '.spider', '.tif', '.tiff', '.xbm', '.xpm'
-    )
+    shrink_to_fit: bool = False
+    supported_extensions: FrozenSet[str] = SUPPORTED_EXTENSIONS
 
     def resize_image(self) -> None:
         try:
@@ -36,8 +46,12 @@ class ImageResizer:
                 raise ValueError(
                     f"Nieobsługiwane rozszerzenie pliku: {input_file.suffix}")
 
-            image: Image.Image = self._load_image(input_file)
-            resized_image: Image.Image = self._resize_to_max_dimensions(image)
+            image: Image.Image = Image.open(input_file)
+            target_size: Tuple[int, int] = self._calculate_target_size(
+                *image.size)
+            image = self._load_image(image, target_size)
+            resized_image: Image.Image = self._resize_to_max_dimensions(
+                image, target_size)
             output_file: Path = self.output_path / self.input_filename
             self._reduce_file_size_and_save(resized_image, output_file)
 
@@ -46,18 +60,17 @@ class ImageResizer:
         except Exception as e:
             print(f"Wystąpił błąd podczas przetwarzania obrazu: {str(e)}")
 
-    def _load_image(self, file_path: Path) -> Image.Image:
-        return Image.open(file_path).convert("RGB")
+    def _load_image(self, image: Image.Image, target_size: Tuple[int, int]) -> Image.Image:
+        image.draft("RGB", target_size)
+        return image if image.mode == "RGB" else image.convert("RGB")
 
-    def _resize_to_max_dimensions(self, image: Image.Image) -> Image.Image:
+    def _resize_to_max_dimensions(self, image: Image.Image, target_size: Tuple[int, int]) -> Image.Image:
         width: int
         height: int
         width, height = image.size
-        target_size: Tuple[int, int] = self._calculate_target_size(
-            width, height)
 
         if width > target_size[0] or height > target_size[1]:
-            return image.resize(target_size, Image.Resampling.LANCZOS)
+            return image.resize(target_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
         return image
 
     def _calculate_target_size(self, width: int, height: int) -> Tuple[int, int]:
@@ -91,15 +104,69 @@ class ImageResizer:
         return (new_width, new_height)
 
     def _reduce_file_size_and_save(self, image: Image.Image, output_file: Path) -> None:
-        quality: int = 95
-        while True:
-            image.save(output_file, format="JPEG", quality=quality)
-            if stat(output_file).st_size <= self.max_size_mb * 1024 * 1024:
+        max_size_bytes: float = self.max_size_mb * 1024 * 1024
+        previous_round: Optional[Tuple[int, int]] = None
+        for _ in range(MAX_DOWNSCALE_ATTEMPTS + 1):
+            data: Optional[bytes]
+            smallest_size: Optional[int]
+            data, smallest_size = self._search_quality(image, max_size_bytes)
+            if data is not None:
+                output_file.write_bytes(data)
+                return
+            if not self.shrink_to_fit:
                 break
-            quality -= 5
-            if quality < 20:
-                raise ValueError(
-                    "Nie można zmniejszyć rozmiaru pliku do żądanej wielkości.")
+
+            width: int
+            height: int
+            width, height = image.size
+            pixels: int = width * height
+            exponent: float = 1.0
+            if previous_round is not None:
+                previous_pixels: int
+                previous_size: int
+                previous_pixels, previous_size = previous_round
+                if previous_size > smallest_size:
+                    exponent = log(previous_size / smallest_size) / \
+                        log(previous_pixels / pixels)
+                    exponent = min(max(exponent, 0.25), 1.0)
+            previous_round = (pixels, smallest_size)
+
+            scale: float = (max_size_bytes * 0.95 /
+                            smallest_size) ** (1 / (2 * exponent))
+            new_size: Tuple[int, int] = (
+                max(1, int(width * scale)), max(1, int(height * scale)))
+            if new_size == (width, height):
+                break
+            print(
+                f"Najniższa jakość przekracza {self.max_size_mb} MB, zmniejszam {width}x{height} do {new_size[0]}x{new_size[1]}: {self.input_filename}")
+            image = image.resize(
+                new_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+        raise ValueError(
+            "Nie można zmniejszyć rozmiaru pliku do żądanej wielkości.")
+
+    def _search_quality(self, image: Image.Image, max_size_bytes: float) -> Tuple[Optional[bytes], Optional[int]]:
+        qualities: range = range(20, 100, 5)
+        best: Optional[bytes] = None
+        smallest_size: Optional[int] = None
+        low: int = 0
+        high: int = len(qualities) - 1
+        mid: int = high
+        while low <= high:
+            data: bytes = self._encode_jpeg(image, qualities[mid])
+            if len(data) <= max_size_bytes:
+                best = data
+                low = mid + 1
+            else:
+                smallest_size = len(data)
+                high = mid - 1
+            mid = (low + high) // 2
+        return best, smallest_size
+
+    def _encode_jpeg(self, image: Image.Image, quality: int) -> bytes:
+        buffer: BytesIO = BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, subsampling=2, optimize=False)
+        return buffer.getvalue()
 
 
 def main() -> None:
@@ -110,21 +177,25 @@ def main() -> None:
     max_size_px: int = int(input(
         "Podaj długość największej krawędzi w px np.: 1024, 2048, 4096, 8192: ") or 4096)
     resize_mode: ResizeMode = ResizeMode.LONGEST_EDGE
+    shrink_to_fit: bool = input(
+        "Zmniejszyć wymiary, jeśli nawet najniższa jakość przekracza limit MB? (t/N): ").strip().lower() == "t"
 
     if not output_path.exists():
         output_path.mkdir(parents=True)
 
-    for file in input_path.iterdir():
-        if file.is_file() and file.suffix.lower() in ImageResizer("", Path(), Path(), 0, 0, ResizeMode.LONGEST_EDGE).supported_extensions:
-            resizer: ImageResizer = ImageResizer(
-                input_filename=file.name,
-                input_path=input_path,
-                output_path=output_path,
-                max_size_mb=max_size_mb,
-                max_size_px=max_size_px,
-                resize_mode=resize_mode
-            )
-            resizer.resize_image()
+    with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+        for file in input_path.iterdir():
+            if file.is_file() and file.suffix.lower() in SUPPORTED_EXTENSIONS:
+                resizer: ImageResizer = ImageResizer(
+                    input_filename=file.name,
+                    input_path=input_path,
+                    output_path=output_path,
+                    max_size_mb=max_size_mb,
+                    max_size_px=max_size_px,
+                    resize_mode=resize_mode,
+                    shrink_to_fit=shrink_to_fit
+                )
+                executor.submit(resizer.resize_image)
 
     print("Zakończono przetwarzanie wszystkich obrazów.")
 